@@ -12,11 +12,26 @@ example given in the `Flask Extension Development
 __version__ = '0.3.0-dev'
 
 
-from threading import RLock
+import atexit
+import heapq
+import json
+import logging
+import os
+import random
+import signal
+import sys
+import time
+from threading import Condition, Lock, RLock, Thread, current_thread, local
+from weakref import WeakSet
 
 from cuttlepool import CuttlePool, CuttlePoolError, PoolConnection
 from flask import current_app
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 try:
     from cuttlepool import _CAPACITY, _OVERFLOW, _TIMEOUT
 except ImportError:
@@ -32,6 +47,15 @@ try:
 except ImportError:
     from flask import _request_ctx_stack as stack
 
+# How often in seconds a draining pool checks for connections that were lost
+# without being returned.
+_DRAIN_INTERVAL = 0.1
+
+# Put in the queue of a drained pool to wake threads waiting for a connection.
+_CLOSED = object()
+
+logger = logging.getLogger(__name__)
+
 
 def cuttlepool_factory(ping_fn, normalize_fn):
     """
@@ -42,7 +66,22 @@ def cuttlepool_factory(ping_fn, normalize_fn):
         normalize_connection method.
     """
     class SQLPool(CuttlePool):
+        def __init__(self, *args, **kwargs):
+            super(SQLPool, self).__init__(*args, **kwargs)
+            self._closed = False
+            # Notified whenever a connection is returned to the pool.
+            self._returned = Condition()
+
         def ping(self, connection):
+            if connection is _CLOSED:
+                # Pass the wake up on to the next waiting thread.
+                try:
+                    self._pool.put_nowait(_CLOSED)
+                except queue.Full:
+                    pass
+                raise CuttlePoolError('Could not get connection, the pool is '
+                                      'closed')
+
             if ping_fn is not None:
                 return ping_fn(connection)
             return super(SQLPool, self).ping(connection)
@@ -53,9 +92,342 @@ def cuttlepool_factory(ping_fn, normalize_fn):
             else:
                 super(SQLPool, self).normalize_connection(connection)
 
+        def get_connection(self, preferred=None):
+            if self._closed:
+                raise CuttlePoolError('Could not get connection, the pool is '
+                                      'closed')
+
+            if preferred is not None:
+                connection = self._reclaim(preferred)
+
+                if connection is not None:
+                    if self.ping(connection):
+                        self.normalize_connection(connection)
+                        return PoolConnection(connection, self)
+
+                    with self.lock:
+                        self._reference_pool.remove(connection)
+
+            return super(SQLPool, self).get_connection()
+
+        def _reclaim(self, preferred):
+            """
+            Takes the connection whose ``id()`` is ``preferred`` out of the
+            pool if it is idle.
+
+            :return: The connection or ``None`` if it isn't in the pool.
+            """
+            # Queue has no way to get a specific item, so work on its deque
+            # the same way Queue.get() does.
+            q = self._pool
+            with q.mutex:
+                for connection in q.queue:
+                    if id(connection) == preferred:
+                        q.queue.remove(connection)
+                        q.not_full.notify()
+                        return connection
+
+        def put_connection(self, connection):
+            with self.lock:
+                if self._closed and connection not in self._reference_pool:
+                    # The pool was emptied while this connection was checked
+                    # out, so there is nothing left to return it to.
+                    if self.ping(connection):
+                        connection.close()
+                    return
+
+            super(SQLPool, self).put_connection(connection)
+
+            with self._returned:
+                self._returned.notify_all()
+
+        def drain(self, timeout=None):
+            """
+            Stops new checkouts, waits for connections in use to be returned
+            and closes every connection in parallel. Connections still in use
+            when ``timeout`` expires are closed as well.
+
+            :param timeout: Time in seconds to wait for connections in use.
+                Waits indefinitely if ``None``.
+
+            :return: ``True`` if every connection was returned before being
+                closed, otherwise ``False``.
+            """
+            if timeout is not None:
+                deadline = time.time() + timeout
+
+            with self.lock:
+                self._closed = True
+
+            # self._returned must not be held while taking self.lock, since
+            # put_connection() can be called with self.lock held.
+            while True:
+                self._harvest_lost_connections()
+                if self._pool.qsize() >= self._size:
+                    break
+
+                wait = _DRAIN_INTERVAL
+                if timeout is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    wait = min(wait, remaining)
+
+                with self._returned:
+                    self._returned.wait(wait)
+
+            with self.lock:
+                drained = self._pool.qsize() >= self._size
+                connections = self._reference_pool
+                self._reference_pool = []
+
+            threads = [Thread(target=self._close_connection, args=(con,))
+                       for con in connections]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.empty_pool()
+            # Wake any threads waiting on the queue for a connection.
+            self._pool.put_nowait(_CLOSED)
+
+            return drained
+
+        def _close_connection(self, connection):
+            """
+            Closes a connection, ignoring any errors since the pool is being
+            shut down.
+            """
+            try:
+                if self.ping(connection):
+                    connection.close()
+            except Exception:
+                pass
+
     return SQLPool
 
 
+class QueryProfile(object):
+    """
+    Database statistics for a single application context.
+
+    :param int slowest: The number of slowest statements to keep.
+    :param int repeated: Statements executed more than this many times are
+        reported by ``repeated_statements``.
+    :param float slow_query_time: Statements taking at least this many seconds
+        are logged as slow queries. No statements are logged if ``None``.
+    :param bool trace: If ``True``, every checkout and statement is kept in
+        order on ``events``. Defaults to ``False``.
+    """
+
+    def __init__(self, slowest=5, repeated=10, slow_query_time=None,
+                 trace=False):
+        self.queries = 0
+        self.total_time = 0.0
+        self.checkout_time = 0.0
+        self.statements = {}
+        self.started = time.time()
+        # Set on teardown.
+        self.ended = None
+        # Tuples of ('checkout', offset, wait) and
+        # ('query', offset, duration, statement), where offset is the time in
+        # seconds since ``started``.
+        self.events = [] if trace else None
+
+        self._slowest = slowest
+        self._repeated = repeated
+        self._slow_query_time = slow_query_time
+        # Min heap of (duration, query number, statement) so the fastest of
+        # the slowest statements is discarded first. The query number breaks
+        # ties, since statements can't always be compared.
+        self._heap = []
+
+    @property
+    def slowest(self):
+        """
+        A list of ``(duration, statement)`` tuples for the slowest statements,
+        slowest first.
+        """
+        return [(duration, statement) for duration, _, statement
+                in sorted(self._heap, reverse=True)]
+
+    @property
+    def repeated_statements(self):
+        """
+        A dict of statements executed more times than the ``repeated``
+        threshold mapped to the number of times they were executed. These are
+        often a sign of N+1 queries.
+        """
+        return {sql: count for sql, count in self.statements.items()
+                if count > self._repeated}
+
+    def record(self, statement, duration):
+        """
+        Records an executed statement.
+
+        :param statement: The SQL statement.
+        :param float duration: Time in seconds the statement took to execute.
+        """
+        if self.events is not None:
+            offset = time.time() - duration - self.started
+            self.events.append(('query', offset, duration, statement))
+
+        self.queries += 1
+        self.total_time += duration
+
+        # Some statement objects, like psycopg2's sql.Composed, can't be
+        # hashed, so count those by their string form.
+        try:
+            hash(statement)
+            key = statement
+        except TypeError:
+            key = str(statement)
+        self.statements[key] = self.statements.get(key, 0) + 1
+
+        if len(self._heap) < self._slowest:
+            heapq.heappush(self._heap, (duration, self.queries, statement))
+        elif self._heap and duration > self._heap[0][0]:
+            heapq.heapreplace(self._heap,
+                              (duration, self.queries, statement))
+
+        if (self._slow_query_time is not None and
+                duration >= self._slow_query_time):
+            logger.warning('Slow query (%.3fs): %s', duration, statement)
+
+    def record_checkout(self, wait):
+        """
+        Records a connection checkout.
+
+        :param float wait: Time in seconds spent waiting for the connection.
+        """
+        if self.events is not None:
+            offset = time.time() - wait - self.started
+            self.events.append(('checkout', offset, wait))
+
+        self.checkout_time += wait
+
+
+class TraceRecorder(object):
+    """
+    A profile handler that writes the trace of each ``QueryProfile`` as a line
+    of JSON. Profiling must be enabled with ``trace=True``. Each line has the
+    form::
+
+      {"start": 1700000000.0, "end": 0.05, "pid": 1, "thread": 1,
+       "events": [["checkout", 0.0, 0.001],
+                  ["query", 0.002, 0.01, "SELECT 1"]]}
+
+    where ``end`` and event offsets are in seconds since ``start``.
+
+    :param fileobj: A file object opened for writing text.
+    """
+
+    def __init__(self, fileobj):
+        self._file = fileobj
+        self._lock = Lock()
+
+    def __call__(self, profile):
+        """
+        Writes the trace of ``profile``.
+
+        :raises ValueError: If ``profile`` wasn't made with ``trace=True``.
+        """
+        if profile.events is None:
+            raise ValueError('Profile has no trace, enable profiling with '
+                             'trace=True')
+
+        # Forked workers can share thread idents, so the pid is needed to
+        # tell their threads apart.
+        line = json.dumps({'start': profile.started,
+                           'end': profile.ended - profile.started,
+                           'pid': os.getpid(),
+                           'thread': current_thread().ident,
+                           'events': profile.events},
+                          separators=(',', ':'),
+                          # Statements aren't always strings, e.g. bytes or
+                          # psycopg2's sql.Composed.
+                          default=str)
+
+        with self._lock:
+            self._file.write(line + '\n')
+
+
+class ProfiledConnection(PoolConnection):
+    """
+    A ``PoolConnection`` whose cursors record executed statements on a
+    ``QueryProfile``.
+
+    :param PoolConnection pool_connection: The connection to take over.
+        ``pool_connection`` will no longer return its connection to the pool.
+    :param QueryProfile profile: The profile to record statements on.
+    """
+
+    def __init__(self, pool_connection, profile):
+        super(ProfiledConnection, self).__init__(pool_connection._connection,
+                                                 pool_connection._pool)
+        pool_connection._connection = pool_connection._pool = None
+        # Bypass PoolConnection.__setattr__, which sets attributes on the
+        # underlying connection.
+        self.__dict__['_profile'] = profile
+
+    def cursor(self, *args, **kwargs):
+        """
+        Gets a ``ProfiledCursor`` wrapping a cursor from the underlying
+        connection.
+        """
+        return ProfiledCursor(self._connection.cursor(*args, **kwargs),
+                              self._profile)
+
+
+class ProfiledCursor(object):
+    """
+    A wrapper around a cursor object that times ``execute()`` and
+    ``executemany()``.
+
+    :param cursor: A cursor object.
+    :param QueryProfile profile: The profile to record statements on.
+    """
+
+    def __init__(self, cursor, profile):
+        self._cursor = cursor
+        self._profile = profile
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._cursor.close()
+
+    def __getattr__(self, attr):
+        """
+        Gets attributes of cursor object.
+        """
+        return getattr(self._cursor, attr)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, statement, *args, **kwargs):
+        return self._timed(self._cursor.execute, statement, *args, **kwargs)
+
+    def executemany(self, statement, *args, **kwargs):
+        return self._timed(self._cursor.executemany, statement, *args,
+                           **kwargs)
+
+    def _timed(self, fn, statement, *args, **kwargs):
+        start = time.time()
+        try:
+            return fn(statement, *args, **kwargs)
+        finally:
+            duration = time.time() - start
+            # Profiling must never make a statement fail.
+            try:
+                self._profile.record(statement, duration)
+            except Exception:
+                logger.exception('Could not profile statement: %s', statement)
+
+
 class FlaskCuttlePool(object):
     """
     An SQL connection pool for Flask applications.
@@ -82,7 +454,13 @@ class FlaskCuttlePool(object):
                                        timeout=timeout)
 
         self._ping = self._normalize = self._CuttlePool = None
+        self._profile_handler = self._profile_options = None
+        self._sample_rate = 1.0
+        self._affinity = None
         self._lock = RLock()    # Necessary for multithreaded apps.
+        # Every pool made by this instance, across all apps, so they can be
+        # drained on shutdown without an application context.
+        self._pools = WeakSet()
 
         if app is not None:
             self.init_app(app)
@@ -125,6 +503,50 @@ class FlaskCuttlePool(object):
 
         return app
 
+    def _checkout(self, ctx):
+        """
+        Gets a connection for the application context, profiling it if
+        profiling is enabled and the context was sampled.
+        """
+        if not hasattr(ctx, 'cuttlepool_profile'):
+            ctx.cuttlepool_profile = None
+
+            options = self._profile_options
+            if options is not None and random.random() < self._sample_rate:
+                ctx.cuttlepool_profile = QueryProfile(**options)
+
+        profile = ctx.cuttlepool_profile
+        if profile is None:
+            return self._get_preferred_connection()
+
+        start = time.time()
+        con = self._get_preferred_connection()
+        profile.record_checkout(time.time() - start)
+
+        return ProfiledConnection(con, profile)
+
+    def _get_preferred_connection(self):
+        """
+        Gets a ``PoolConnection`` object, preferring the connection last used
+        by the current thread when connection affinity is enabled.
+        """
+        pool = self.get_pool()
+
+        if self._affinity is None:
+            return pool.get_connection()
+
+        preferred = getattr(self._affinity, 'connections', {}).get(id(pool))
+        return pool.get_connection(preferred)
+
+    def _stop_checkouts(self):
+        """
+        Makes every pool made by this instance refuse new checkouts without
+        waiting for or closing any connections. Safe to call from a signal
+        handler.
+        """
+        for pool in list(self._pools):
+            pool._closed = True
+
     def _make_pool(self, app):
         """
         Make a CuttlePool instance. All configuration options on ``app.config``
@@ -157,6 +579,55 @@ class FlaskCuttlePool(object):
 
         return self._CuttlePool(self._connect, **kwargs)
 
+    def close(self):
+        """
+        Closes every pool made by this instance without waiting for
+        connections in use to be returned. Equivalent to ``drain(timeout=0)``.
+        """
+        return self.drain(timeout=0)
+
+    def close_on_exit(self, timeout=10, signals=(signal.SIGTERM,)):
+        """
+        Drains every pool made by this instance when the interpreter exits.
+        When one of ``signals`` is received, any handler previously installed
+        for the signal is called. If that handler exits, or there was no
+        previous handler and the interpreter exits with ``SystemExit``, the
+        pools stop handing out new connections first. Connections in use are
+        left alone so requests in flight can finish before the pools are
+        drained on exit. Signals that are ignored are left ignored.
+
+        .. note:: Signal handlers can only be installed from the main thread.
+
+        :param timeout: Time in seconds to wait on exit for connections in
+            use. Defaults to ``10``. Waits indefinitely if ``None``, which
+            keeps the interpreter from exiting while any connection is held.
+        :param signals: An iterable of signal numbers. Defaults to
+            ``(signal.SIGTERM,)``.
+        """
+        atexit.register(self.drain, timeout)
+
+        for signum in signals:
+            previous = signal.getsignal(signum)
+
+            if previous == signal.SIG_IGN:
+                continue
+
+            # Draining in the handlers could wait forever on a connection held
+            # by the interrupted frame, so they only stop new checkouts and
+            # only when the process is exiting.
+            def handler(signum, frame, previous=previous):
+                if not callable(previous):
+                    self._stop_checkouts()
+                    sys.exit(128 + signum)
+
+                try:
+                    previous(signum, frame)
+                except BaseException:
+                    self._stop_checkouts()
+                    raise
+
+            signal.signal(signum, handler)
+
     def commit(self):
         """
         Commits the connection on the application context.
@@ -171,6 +642,80 @@ class FlaskCuttlePool(object):
 
         raise RuntimeError("There's no connection on the application context.")
 
+    def drain(self, timeout=None):
+        """
+        Drains every pool made by this instance. Each pool stops handing out
+        connections, waits for connections in use to be returned and then
+        closes all of its connections. Connections still in use when
+        ``timeout`` expires are closed as well.
+
+        :param timeout: Time in seconds to wait for connections in use. Waits
+            indefinitely if ``None``.
+
+        :return: ``True`` if every connection was returned before being
+            closed, otherwise ``False``.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        with self._lock:
+            pools = list(self._pools)
+
+        drained = True
+        for pool in pools:
+            remaining = None
+            if timeout is not None:
+                remaining = max(deadline - time.time(), 0)
+            drained = pool.drain(remaining) and drained
+
+        return drained
+
+    def enable_affinity(self):
+        """
+        Makes each thread prefer the connection it last used through the
+        ``connection`` property. On teardown the connection is returned to the
+        pool as usual, but the next application context on the same thread
+        takes that connection back if it is still idle. If another thread took
+        it in the meantime, a connection is retrieved from the pool as normal.
+        """
+        if self._affinity is None:
+            self._affinity = local()
+
+    def enable_profiling(self, sample_rate=1.0, slowest=5, repeated=10,
+                         slow_query_time=None, trace=False):
+        """
+        Profiles statements executed with cursors from the ``connection`` and
+        ``cursor`` properties. A ``QueryProfile`` is kept for each sampled
+        application context and passed to the ``profile_handler`` callback on
+        teardown. Statements executed more than ``repeated`` times in one
+        application context are logged as possible N+1 queries.
+
+        :param float sample_rate: The fraction of application contexts to
+            profile. Contexts that aren't sampled aren't profiled at all.
+        :param int slowest: The number of slowest statements to keep.
+        :param int repeated: The number of times a statement can be executed
+            before it is reported as repeated.
+        :param float slow_query_time: Statements taking at least this many
+            seconds are logged as slow queries. Defaults to ``None``, which
+            disables the slow query log.
+        :param bool trace: If ``True``, profiles keep every checkout and
+            statement in order so they can be recorded with a
+            ``TraceRecorder``. Defaults to ``False``.
+
+        :raises ValueError: If ``trace`` is ``True`` and ``sample_rate`` is
+            less than 1, since a sampled trace doesn't reflect the real
+            traffic.
+        """
+        if trace and sample_rate < 1:
+            raise ValueError('Traces must not be sampled, sample_rate must be '
+                             '1 when trace=True')
+
+        self._sample_rate = sample_rate
+        self._profile_options = {'slowest': slowest,
+                                 'repeated': repeated,
+                                 'slow_query_time': slow_query_time,
+                                 'trace': trace}
+
     def get_connection(self):
         """
         Gets a ``PoolConnection`` object. The caller of this method is
@@ -192,6 +737,7 @@ class FlaskCuttlePool(object):
             if pool is None:
                 pool = self._make_pool(app)
                 app.extensions['cuttlepool'][id(self)] = pool
+                self._pools.add(pool)
 
             return pool
 
@@ -217,15 +763,47 @@ class FlaskCuttlePool(object):
         """
         self._normalize = fn
 
+    def profile_handler(self, fn):
+        """
+        Decorator for setting a callback that receives the ``QueryProfile`` of
+        each profiled application context on teardown. See
+        ``enable_profiling()``.
+
+        :param fn: A function.
+        """
+        self._profile_handler = fn
+
     def teardown(self, exception):
         """
         Calls the ``PoolConnection``'s ``close()`` method, which puts the
-        connection back in the pool.
+        connection back in the pool. Reports the ``QueryProfile`` if the
+        application context was profiled.
         """
         ctx = stack.top
 
         if hasattr(ctx, 'cuttlepool_connection'):
-            ctx.cuttlepool_connection.close()
+            con = ctx.cuttlepool_connection
+
+            if self._affinity is not None and con._connection is not None:
+                # Remember the connection by id() rather than by reference
+                # since CuttlePool relies on reference counts to find lost
+                # connections.
+                if not hasattr(self._affinity, 'connections'):
+                    self._affinity.connections = {}
+                self._affinity.connections[id(con._pool)] = id(con._connection)
+
+            con.close()
+
+        profile = getattr(ctx, 'cuttlepool_profile', None)
+        if profile is not None:
+            profile.ended = time.time()
+
+            for sql, count in profile.repeated_statements.items():
+                logger.warning('Query executed %d times, possible N+1 '
+                               'query: %s', count, sql)
+
+            if self._profile_handler is not None:
+                self._profile_handler(profile)
 
     @property
     def connection(self):
@@ -239,7 +817,7 @@ class FlaskCuttlePool(object):
 
         if ctx is not None:
             if not hasattr(ctx, 'cuttlepool_connection'):
-                ctx.cuttlepool_connection = self.get_connection()
+                ctx.cuttlepool_connection = self._checkout(ctx)
 
             con = ctx.cuttlepool_connection
 
@@ -247,7 +825,7 @@ class FlaskCuttlePool(object):
             # Ensure connection is open.
             if con._connection is None or not pool.ping(con):
                 ctx.cuttlepool_connection.close()
-                ctx.cuttlepool_connection = self.get_connection()
+                ctx.cuttlepool_connection = self._checkout(ctx)
 
             return ctx.cuttlepool_connection
 
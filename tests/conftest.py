@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Fixtures shared by the Flask-CuttlePool tests."""
+import pytest
+from flask import Flask
+
+
+@pytest.fixture
+def user():
+    return 'paul_hollywood'
+
+
+@pytest.fixture
+def password():
+    return 'bread_is_the_best'
+
+
+@pytest.fixture
+def host():
+    return 'an_ip_address_in_england'
+
+
+@pytest.fixture
+def user2():
+    return 'marry_berry'
+
+
+@pytest.fixture
+def password2():
+    return 'cake_and_margaritas'
+
+
+@pytest.fixture
+def host2():
+    return 'another_ip_address_in_england'
+
+
+def create_app(u, p, h):
+    app = Flask(__name__)
+    app.testing = True
+    app.config.update(
+        CUTTLEPOOL_USER=u,
+        CUTTLEPOOL_PASSWORD=p,
+        CUTTLEPOOL_HOST=h
+    )
+    return app
+
+
+@pytest.fixture
+def app(user, password, host):
+    """A Flask ``app`` instance."""
+    return create_app(user, password, host)
+
+
+@pytest.fixture
+def app2(user2, password2, host2):
+    """A Flask ``app`` instance."""
+    return create_app(user2, password2, host2)
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the Flask-CuttlePool tests.
+"""
+
+
+def add_decorators(p):
+    """Adds ping and normalize decorators to pool."""
+    @p.ping
+    def ping(con):
+        return True
+
+    @p.normalize_connection
+    def normalize(con):
+        pass
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Replays traces recorded with ``flask_cuttlepool.TraceRecorder`` against a
+``FlaskCuttlePool`` using a mock driver that reproduces the recorded query
+latencies. Useful for comparing pool changes against real traffic.
+
+Usage::
+
+  python tests/replay.py trace.jsonl --capacity 5 --overflow 1
+"""
+import argparse
+import json
+import threading
+import time
+
+from flask import Flask
+
+import mocksql
+from flask_cuttlepool import CuttlePoolError, FlaskCuttlePool
+
+
+class ReplayCursor(mocksql.MockCursor):
+    """
+    A mock Cursor object that takes as long to execute a query as it took
+    when it was recorded.
+    """
+
+    def execute(self, query, latency=0):
+        """
+        "Executes" a query.
+
+        :param float latency: Time in seconds the query takes.
+        """
+        time.sleep(latency)
+
+
+def load(fileobj):
+    """
+    Loads trace records from a file object, ordered by start time.
+
+    :param fileobj: A file object with a JSON record on each line.
+    """
+    records = [json.loads(line) for line in fileobj if line.strip()]
+    records.sort(key=lambda record: record['start'])
+    return records
+
+
+def replay(make_pool, records, speed=1.0):
+    """
+    Replays trace records. Records keep their recorded start times relative to
+    the first record, and records from the same recorded thread are replayed
+    in order on the same thread. Each recorded process gets its own app and
+    pool, as it had when the trace was recorded.
+
+    :param make_pool: A function returning a new Flask ``app`` object and a
+        new ``FlaskCuttlePool`` initialized with it. Pools are closed when the
+        replay is done.
+    :param records: A list of trace records ordered by start time.
+    :param float speed: Replay speed relative to the recorded speed.
+
+    :return: A list with a dict for each record with ``elapsed``, the time
+        the application context was open, ``checkout_time``, the time spent
+        waiting for connections, and ``error``, the ``CuttlePoolError`` message
+        if replaying the record failed, otherwise ``None``.
+    """
+    if not records:
+        return []
+
+    pools = {}
+    threads = {}
+    for index, record in enumerate(records):
+        if record['pid'] not in pools:
+            pools[record['pid']] = make_pool()
+        key = (record['pid'], record['thread'])
+        threads.setdefault(key, []).append(index)
+
+    results = [None] * len(records)
+    first = records[0]['start']
+    started = time.time()
+
+    def run(indices):
+        for index in indices:
+            record = records[index]
+            _sleep_until(started + (record['start'] - first) / speed)
+            app, pool = pools[record['pid']]
+            results[index] = _replay_record(pool, app, record, speed)
+
+    workers = [threading.Thread(target=run, args=(indices,))
+               for indices in threads.values()]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    for _, pool in pools.values():
+        pool.close()
+
+    return results
+
+
+def summarize(results):
+    """
+    Summarizes the results of ``replay()``. Timings only include records that
+    were replayed successfully and are ``None`` if there are none.
+
+    :param results: A list of results returned by ``replay()``.
+    """
+    ok = [result for result in results if result['error'] is None]
+    summary = {
+        'records': len(results),
+        'failures': len(results) - len(ok),
+        'mean_elapsed': None,
+        'p95_elapsed': None,
+        'mean_checkout_time': None,
+        'max_checkout_time': None,
+    }
+
+    n = len(ok)
+    if n == 0:
+        return summary
+
+    elapsed = sorted(result['elapsed'] for result in ok)
+    checkout = sorted(result['checkout_time'] for result in ok)
+    summary.update(
+        mean_elapsed=sum(elapsed) / n,
+        p95_elapsed=elapsed[int(0.95 * (n - 1))],
+        mean_checkout_time=sum(checkout) / n,
+        max_checkout_time=checkout[-1])
+
+    return summary
+
+
+def _replay_record(pool, app, record, speed):
+    """
+    Replays a single trace record in its own application context.
+    """
+    start = time.time()
+    checkout_time = 0.0
+    error = None
+
+    with app.app_context():
+        try:
+            for event in record['events']:
+                _sleep_until(start + event[1] / speed)
+
+                # Only checks out a connection when there isn't one on the
+                # application context.
+                before = time.time()
+                try:
+                    con = pool.connection
+                finally:
+                    checkout_time += time.time() - before
+
+                if event[0] == 'query':
+                    cur = con.cursor(cursorclass=ReplayCursor)
+                    cur.execute(event[3], event[2] / speed)
+                    cur.close()
+
+            _sleep_until(start + record['end'] / speed)
+        except CuttlePoolError as e:
+            error = str(e)
+
+    return {'elapsed': time.time() - start, 'checkout_time': checkout_time,
+            'error': error}
+
+
+def _sleep_until(deadline):
+    remaining = deadline - time.time()
+    if remaining > 0:
+        time.sleep(remaining)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('trace', help='A trace file written by TraceRecorder.')
+    parser.add_argument('--capacity', type=int, default=5)
+    parser.add_argument('--overflow', type=int, default=1)
+    parser.add_argument('--timeout', type=int, default=None)
+    parser.add_argument('--speed', type=float, default=1.0)
+    parser.add_argument('--affinity', action='store_true',
+                        help='Enable thread connection affinity.')
+    args = parser.parse_args(argv)
+
+    with open(args.trace) as f:
+        records = load(f)
+
+    def make_pool():
+        # Pools on the same app share the connection on the application
+        # context, so each pool needs its own app.
+        app = Flask(__name__)
+        pool = FlaskCuttlePool(mocksql.connect, capacity=args.capacity,
+                               overflow=args.overflow, timeout=args.timeout,
+                               app=app)
+
+        @pool.ping
+        def ping(con):
+            return con.open
+
+        @pool.normalize_connection
+        def normalize(con):
+            pass
+
+        if args.affinity:
+            pool.enable_affinity()
+
+        return app, pool
+
+    results = replay(make_pool, records, speed=args.speed)
+
+    for key, value in sorted(summarize(results).items()):
+        print('{0}: {1}'.format(key, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
 """Tests for Flask-CuttlePool."""
+import io
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
 import pytest
-from flask import Flask
 
 # Find the stack on which we want to store the database connection.
 # Starting with Flask 0.9, the _app_ctx_stack is the correct one,
@@ -11,73 +18,12 @@ try:
 except ImportError:
     from flask import _request_ctx_stack as stack
 
+import flask_cuttlepool
 import mocksql
 from flask_cuttlepool import (_CAPACITY, _OVERFLOW, _TIMEOUT, CuttlePool,
-                              FlaskCuttlePool, PoolConnection)
-
-
-@pytest.fixture
-def user():
-    return 'paul_hollywood'
-
-
-@pytest.fixture
-def password():
-    return 'bread_is_the_best'
-
-
-@pytest.fixture
-def host():
-    return 'an_ip_address_in_england'
-
-
-@pytest.fixture
-def user2():
-    return 'marry_berry'
-
-
-@pytest.fixture
-def password2():
-    return 'cake_and_margaritas'
-
-
-@pytest.fixture
-def host2():
-    return 'another_ip_address_in_england'
-
-
-def create_app(u, p, h):
-    app = Flask(__name__)
-    app.testing = True
-    app.config.update(
-        CUTTLEPOOL_USER=u,
-        CUTTLEPOOL_PASSWORD=p,
-        CUTTLEPOOL_HOST=h
-    )
-    return app
-
-
-@pytest.fixture
-def app(user, password, host):
-    """A Flask ``app`` instance."""
-    return create_app(user, password, host)
-
-
-@pytest.fixture
-def app2(user2, password2, host2):
-    """A Flask ``app`` instance."""
-    return create_app(user2, password2, host2)
-
-
-def add_decorators(p):
-    """Adds ping and normalize decorators to pool."""
-    @p.ping
-    def ping(con):
-        return True
-
-    @p.normalize_connection
-    def normalize(con):
-        pass
+                              CuttlePoolError, FlaskCuttlePool, PoolConnection,
+                              ProfiledCursor, QueryProfile, TraceRecorder)
+from helpers import add_decorators
 
 
 @pytest.fixture
@@ -339,3 +285,404 @@ def test_normalize_connection_decorator(app, pool_one):
         # means the callback was successfully used by the connection pool.
         assert len(con) == 1
         assert con[0] == 1
+
+
+def test_drain(app, pool_one):
+    """Tests drain waits for connections in use to be returned."""
+    with app.app_context():
+        con = pool_one.connection
+        raw = con._connection
+        timer = threading.Timer(0.05, con.close)
+        timer.start()
+        assert pool_one.drain(timeout=5)
+        timer.join()
+        assert not raw.open
+
+        with pytest.raises(CuttlePoolError):
+            pool_one.get_connection()
+
+
+def test_drain_timeout(app, pool_one):
+    """
+    Tests connections still in use are closed when the drain timeout expires.
+    """
+    with app.app_context():
+        con = pool_one.connection
+        raw = con._connection
+        assert not pool_one.drain(timeout=0)
+        assert not raw.open
+
+    # Teardown returned the connection to the closed pool without error.
+    assert con._connection is None
+
+
+def test_close(pool_two, app, app2):
+    """Tests close closes the pools of every app."""
+    cons = []
+    for a in (app, app2):
+        with a.app_context():
+            con = pool_two.get_connection()
+            cons.append(con._connection)
+            con.close()
+
+    assert pool_two.close()
+    assert not any(con.open for con in cons)
+
+    for a in (app, app2):
+        with a.app_context():
+            with pytest.raises(CuttlePoolError):
+                pool_two.get_connection()
+
+
+def test_close_on_exit(app, pool_one, monkeypatch):
+    """
+    Tests close_on_exit drains the pool at exit, and stops checkouts when
+    the previous signal handler exits.
+    """
+    registered = []
+    monkeypatch.setattr(flask_cuttlepool.atexit, 'register',
+                        lambda *args: registered.append(args))
+
+    def exit_handler(signum, frame):
+        sys.exit()
+
+    previous = signal.signal(signal.SIGUSR1, exit_handler)
+    try:
+        pool_one.close_on_exit(timeout=0, signals=(signal.SIGUSR1,))
+        assert registered == [(pool_one.drain, 0)]
+
+        with app.app_context():
+            pool_one.get_connection().close()
+            with pytest.raises(SystemExit):
+                os.kill(os.getpid(), signal.SIGUSR1)
+
+            with pytest.raises(CuttlePoolError):
+                pool_one.get_connection()
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+
+
+def test_close_on_exit_not_exiting(app, pool_one, monkeypatch):
+    """
+    Tests checkouts aren't stopped when the previous handler returns or the
+    signal is ignored.
+    """
+    monkeypatch.setattr(flask_cuttlepool.atexit, 'register',
+                        lambda *args: None)
+
+    received = []
+    previous1 = signal.signal(signal.SIGUSR1,
+                              lambda signum, frame: received.append(signum))
+    previous2 = signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+    try:
+        pool_one.close_on_exit(signals=(signal.SIGUSR1, signal.SIGUSR2))
+        assert signal.getsignal(signal.SIGUSR2) == signal.SIG_IGN
+
+        with app.app_context():
+            pool_one.get_connection().close()
+            os.kill(os.getpid(), signal.SIGUSR1)
+            os.kill(os.getpid(), signal.SIGUSR2)
+            assert received == [signal.SIGUSR1]
+
+            pool_one.get_connection().close()
+    finally:
+        signal.signal(signal.SIGUSR1, previous1)
+        signal.signal(signal.SIGUSR2, previous2)
+
+
+def test_close_on_exit_connection_in_use(app, pool_one, monkeypatch):
+    """
+    Tests a signal received while a connection is checked out doesn't wait
+    for the connection, which stays usable until teardown.
+    """
+    monkeypatch.setattr(flask_cuttlepool.atexit, 'register',
+                        lambda *args: None)
+
+    received = []
+    previous = signal.signal(signal.SIGUSR1,
+                             lambda signum, frame: received.append(signum))
+    try:
+        pool_one.close_on_exit(signals=(signal.SIGUSR1,))
+
+        with app.app_context():
+            con = pool_one.connection
+            raw = con._connection
+            os.kill(os.getpid(), signal.SIGUSR1)
+            assert received == [signal.SIGUSR1]
+
+            assert pool_one.connection is con
+            assert raw.open
+            pool_one.cursor().execute('SELECT 1')
+
+        assert pool_one.drain()
+        assert not raw.open
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+
+
+def test_close_on_exit_default_handler(app, pool_one, monkeypatch):
+    """
+    Tests the interpreter exits on a signal that had no previous handler.
+    """
+    monkeypatch.setattr(flask_cuttlepool.atexit, 'register',
+                        lambda *args: None)
+
+    previous = signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+    try:
+        pool_one.close_on_exit(signals=(signal.SIGUSR1,))
+
+        with app.app_context():
+            pool_one.connection
+            with pytest.raises(SystemExit):
+                os.kill(os.getpid(), signal.SIGUSR1)
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+
+
+def test_drain_wakes_waiting_threads(app):
+    """
+    Tests threads waiting for a connection get an error when the pool is
+    drained.
+    """
+    pool = FlaskCuttlePool(mocksql.connect, capacity=1, overflow=0, app=app)
+    add_decorators(pool)
+
+    errors = []
+
+    def wait_for_connection(p):
+        try:
+            p.get_connection()
+        except CuttlePoolError as e:
+            errors.append(e)
+
+    with app.app_context():
+        p = pool.get_pool()
+        held = p.get_connection()
+        waiters = [threading.Thread(target=wait_for_connection, args=(p,))
+                   for _ in range(2)]
+        for t in waiters:
+            t.start()
+        # Give the threads time to block on the pool.
+        time.sleep(0.1)
+
+        assert not pool.drain(timeout=0)
+        for t in waiters:
+            t.join(5)
+            assert not t.is_alive()
+        assert len(errors) == 2
+
+        held.close()
+
+
+def test_query_profile():
+    """Tests QueryProfile records statistics about statements."""
+    profile = QueryProfile(slowest=2, repeated=2)
+    for sql, duration in [('a', 0.1), ('b', 0.3), ('a', 0.2), ('c', 0.05),
+                          ('a', 0.1)]:
+        profile.record(sql, duration)
+
+    assert profile.queries == 5
+    assert profile.total_time == pytest.approx(0.75)
+    assert profile.slowest == [(0.3, 'b'), (0.2, 'a')]
+    assert profile.repeated_statements == {'a': 3}
+
+
+def test_query_profile_unorderable_statements():
+    """
+    Tests statements with equal durations don't have to be comparable.
+    """
+    profile = QueryProfile(slowest=2)
+    statements = [object(), object(), object()]
+    for statement in statements:
+        profile.record(statement, 0.1)
+
+    assert profile.slowest == [(0.1, statements[1]), (0.1, statements[0])]
+
+
+def test_query_profile_unhashable_statements(app, pool_one):
+    """
+    Tests statements that can't be hashed are counted by their string form
+    and can be executed with a profiled cursor.
+    """
+    class Statement(object):
+        """Like psycopg2's sql.Composed, defines __eq__ but not __hash__."""
+        def __eq__(self, other):
+            return str(self) == str(other)
+
+        def __str__(self):
+            return 'SELECT 1'
+
+    pool_one.enable_profiling(repeated=1)
+    profiles = []
+    pool_one.profile_handler(profiles.append)
+
+    with app.app_context():
+        cur = pool_one.cursor()
+        cur.execute(Statement())
+        cur.execute(Statement())
+
+    assert profiles[0].queries == 2
+    assert profiles[0].repeated_statements == {'SELECT 1': 2}
+
+
+def test_profiling_errors_are_not_raised(app, pool_one, monkeypatch):
+    """Tests an error while profiling doesn't fail the statement."""
+    def record(self, statement, duration):
+        raise RuntimeError
+
+    monkeypatch.setattr(QueryProfile, 'record', record)
+    pool_one.enable_profiling()
+
+    with app.app_context():
+        pool_one.cursor().execute('SELECT 1')
+
+
+def test_query_profile_slow_query_log(caplog):
+    """Tests slow statements are logged."""
+    profile = QueryProfile(slow_query_time=0.5)
+    profile.record('fast', 0.1)
+    profile.record('slow', 0.5)
+
+    messages = [r.getMessage() for r in caplog.records]
+    assert len(messages) == 1
+    assert 'slow' in messages[0]
+
+
+def test_profiling(app, pool_one):
+    """Tests profiles are recorded and passed to the profile handler."""
+    profiles = []
+    pool_one.enable_profiling(repeated=1)
+    pool_one.profile_handler(profiles.append)
+
+    with app.app_context():
+        assert isinstance(pool_one.connection, PoolConnection)
+        cur = pool_one.cursor()
+        assert isinstance(cur, ProfiledCursor)
+        cur.execute('SELECT 1')
+        cur.execute('SELECT 1')
+        pool_one.connection.cursor().execute('SELECT 2')
+        cur.close()
+        assert cur.connection is None
+
+    assert len(profiles) == 1
+    profile = profiles[0]
+    assert profile.queries == 3
+    assert profile.checkout_time >= 0
+    assert profile.repeated_statements == {'SELECT 1': 2}
+    assert len(profile.slowest) == 3
+
+
+def test_profiling_sample_rate(app, pool_one):
+    """Tests contexts that aren't sampled aren't profiled."""
+    profiles = []
+    pool_one.enable_profiling(sample_rate=0)
+    pool_one.profile_handler(profiles.append)
+
+    with app.app_context():
+        assert isinstance(pool_one.cursor(), mocksql.MockCursor)
+
+    assert profiles == []
+
+
+def test_affinity(app, pool_one):
+    """Tests a thread gets back the connection it last used."""
+    pool_one.enable_affinity()
+
+    with app.app_context():
+        raw = pool_one.connection._connection
+        # Return another connection first so it would be retrieved next
+        # without affinity.
+        pool_one.get_connection().close()
+
+    with app.app_context():
+        assert pool_one.connection._connection is raw
+
+
+def test_affinity_contention(app, pool_one):
+    """
+    Tests a connection is retrieved from the pool when the preferred
+    connection is in use by another thread.
+    """
+    pool_one.enable_affinity()
+
+    with app.app_context():
+        raw = pool_one.connection._connection
+
+    held = []
+    with app.app_context():
+        pool = pool_one.get_pool()
+        t = threading.Thread(
+            target=lambda: held.append(pool.get_connection(id(raw))))
+        t.start()
+        t.join()
+        assert held[0]._connection is raw
+
+        assert pool_one.connection._connection is not raw
+        held[0].close()
+
+
+def test_affinity_per_thread(app, pool_one):
+    """Tests preferred connections aren't shared between threads."""
+    pool_one.enable_affinity()
+
+    with app.app_context():
+        raw = pool_one.connection._connection
+        pool_one.get_connection().close()
+
+    cons = []
+
+    def target():
+        with app.app_context():
+            cons.append(pool_one.connection._connection)
+
+    t = threading.Thread(target=target)
+    t.start()
+    t.join()
+    assert cons[0] is not raw
+
+
+def test_trace_recorder(app, pool_one):
+    """Tests traces of profiled application contexts are recorded."""
+    f = io.StringIO()
+    pool_one.enable_profiling(trace=True)
+    pool_one.profile_handler(TraceRecorder(f))
+
+    with app.app_context():
+        cur = pool_one.cursor()
+        cur.execute('SELECT 1')
+        cur.close()
+
+    record = json.loads(f.getvalue())
+    assert record['pid'] == os.getpid()
+    assert record['thread'] == threading.current_thread().ident
+    assert record['end'] >= 0
+    assert [e[0] for e in record['events']] == ['checkout', 'query']
+    assert record['events'][1][3] == 'SELECT 1'
+
+
+def test_trace_recorder_non_string_statements():
+    """Tests statements that aren't strings are recorded as strings."""
+    f = io.StringIO()
+    profile = QueryProfile(trace=True)
+    profile.record(b'SELECT 1', 0.1)
+    profile.ended = profile.started
+
+    TraceRecorder(f)(profile)
+
+    record = json.loads(f.getvalue())
+    assert record['events'][0][3] == str(b'SELECT 1')
+
+
+def test_trace_recorder_no_trace():
+    """Tests profiles without a trace can't be recorded."""
+    profile = QueryProfile()
+    profile.ended = profile.started
+
+    with pytest.raises(ValueError):
+        TraceRecorder(io.StringIO())(profile)
+
+
+def test_trace_sampled(pool_one):
+    """Tests traces can't be sampled."""
+    with pytest.raises(ValueError):
+        pool_one.enable_profiling(sample_rate=0.5, trace=True)
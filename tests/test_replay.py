@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""Tests for the trace replay runner."""
+import io
+import json
+
+import pytest
+
+from flask import Flask
+
+import mocksql
+import replay
+from flask_cuttlepool import FlaskCuttlePool
+from helpers import add_decorators
+
+
+def pool_factory(timeout=None, affinity=False):
+    """
+    Returns a ``make_pool`` function for ``replay()`` making pools with a
+    single connection.
+    """
+    def make_pool():
+        app = Flask(__name__)
+        app.testing = True
+        p = FlaskCuttlePool(mocksql.connect, capacity=1, overflow=0,
+                            timeout=timeout, app=app)
+        add_decorators(p)
+        if affinity:
+            p.enable_affinity()
+        return app, p
+
+    return make_pool
+
+
+@pytest.fixture
+def make_pool():
+    return pool_factory()
+
+
+def make_record(start, thread, latency, pid=1):
+    return {'start': start, 'end': latency, 'pid': pid, 'thread': thread,
+            'events': [['checkout', 0.0, 0.0],
+                       ['query', 0.0, latency, 'SELECT 1']]}
+
+
+def test_load():
+    """Tests records are loaded ordered by start time."""
+    f = io.StringIO(u'\n'.join(json.dumps(make_record(s, 1, 0))
+                               for s in (2.0, 1.0)))
+    assert [r['start'] for r in replay.load(f)] == [1.0, 2.0]
+
+
+def test_replay_latency(make_pool):
+    """Tests recorded query latencies are reproduced."""
+    results = replay.replay(make_pool, [make_record(0.0, 1, 0.05)])
+
+    assert len(results) == 1
+    assert results[0]['error'] is None
+    assert results[0]['elapsed'] >= 0.05
+
+
+def test_replay_contention(make_pool):
+    """
+    Tests concurrent records from different threads contend for connections.
+    """
+    records = [make_record(0.0, 1, 0.05), make_record(0.0, 2, 0.05)]
+    results = replay.replay(make_pool, records)
+
+    summary = replay.summarize(results)
+    assert summary['records'] == 2
+    assert summary['failures'] == 0
+    assert summary['max_checkout_time'] >= 0.03
+
+
+def test_replay_pool_per_pid(make_pool):
+    """
+    Tests records from different processes are replayed on separate pools,
+    even if their thread idents are the same.
+    """
+    records = [make_record(0.0, 1, 0.05, pid=1),
+               make_record(0.0, 1, 0.05, pid=2)]
+    results = replay.replay(make_pool, records)
+
+    assert all(r['checkout_time'] < 0.03 for r in results)
+    assert max(r['elapsed'] for r in results) < 0.09
+
+
+def test_replay_failures():
+    """Tests records failing with pool errors are counted as failures."""
+    make_pool = pool_factory(timeout=0)
+
+    records = [make_record(0.0, 1, 0.05), make_record(0.0, 2, 0.05)]
+    results = replay.replay(make_pool, records)
+
+    summary = replay.summarize(results)
+    assert summary['failures'] == 1
+    assert summary['mean_elapsed'] is not None
+
+
+def test_replay_affinity_per_pid():
+    """Tests affinity is applied on the pool of each recorded process."""
+    make_affinity_pool = pool_factory(affinity=True)
+    preferred = {}
+
+    def make_pool():
+        app, p = make_affinity_pool()
+        with app.app_context():
+            sql_pool = p.get_pool()
+
+        calls = preferred.setdefault(id(p), [])
+        get_connection = sql_pool.get_connection
+
+        def spy(preferred=None):
+            calls.append(preferred)
+            return get_connection(preferred)
+
+        sql_pool.get_connection = spy
+        return app, p
+
+    records = [make_record(start, 1, 0.01, pid=pid)
+               for start in (0.0, 0.05) for pid in (1, 2)]
+    results = replay.replay(make_pool, records)
+
+    assert all(r['error'] is None for r in results)
+    assert len(preferred) == 2
+    for calls in preferred.values():
+        assert calls[0] is None
+        assert calls[1] is not None
+
+
+def test_summarize_empty():
+    """Tests an empty replay can be summarized."""
+    summary = replay.summarize(replay.replay(None, []))
+
+    assert summary['records'] == 0
+    assert summary['mean_elapsed'] is None